@@ -1,79 +1,295 @@
 import streamlit as st
+import concurrent.futures
+import multiprocessing
 import os
+import stat
 import tempfile
-from markitdown import MarkItDown
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+import xxhash
+from converter_core import PDF_ENGINE, convert_bytes, convert_stream, new_markitdown
 
-# --- Configuration & Page Setup ---
-st.set_page_config(
-    page_title="Universal Document to Markdown Converter",
-    page_icon="📝",
-    layout="centered"
-)
+# Formats whose parsers are pure Python (pdfminer, mammoth, openpyxl, python-pptx)
+# and hold the GIL; these are converted in worker processes instead of threads
+PROCESS_POOL_SUFFIXES = {'.pdf', '.docx', '.xlsx', '.pptx'}
+
+# Upper bound on conversion threads per upload batch; each session gets its own,
+# so one user's slow files never queue behind another's. The threads mostly wait
+# on the process pool or run the cheap HTML path, so this is not tied to CPUs.
+MAX_BATCH_WORKERS = 8
+
+def _usable_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS/Windows
+        return os.cpu_count() or 1
+
+# Worker processes for GIL-bound formats. Each one holds its own MarkItDown
+# (a few hundred MB RSS), and CPU counts ignore container quotas, so cap it.
+PROCESS_POOL_WORKERS = min(_usable_cpus(), int(os.environ.get("AITP_MAX_PROCESS_WORKERS", "4")))
+
+logger = logging.getLogger(__name__)
+
+# Most recent conversions kept per session; older ones are evicted to bound memory
+MAX_STORED_RESULTS = 16
 
 # Custom CSS
-st.markdown("""
-    <style>
-    .stTextArea textarea {
-        font-family: 'Courier New', Courier, monospace;
-        background-color: #f0f2f6;
-    }
-    .metric-card {
-        background-color: #f8f9fa;
-        border: 1px solid #e9ecef;
-        padding: 1rem;
-        border-radius: 0.5rem;
-        margin-bottom: 0.5rem;
-        text-align: center;
-    }
-    .highlight-red { color: #dc3545; font-weight: bold; }
-    .highlight-green { color: #28a745; font-weight: bold; }
-    </style>
-""", unsafe_allow_html=True)
+# Streamlit drops any element a rerun doesn't re-emit, so this has to be injected
+# on every run; keep it to the rules the page actually uses.
+_CSS = """<style>
+.stTextArea textarea { font-family: 'Courier New', Courier, monospace; background-color: #f0f2f6; }
+.highlight-red { color: #dc3545; font-weight: bold; }
+.highlight-green { color: #28a745; font-weight: bold; }
+</style>"""
 
 # --- Helper: Format File Size ---
+_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
 def format_size(size_in_bytes):
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size_in_bytes < 1024.0:
-            return f"{size_in_bytes:.2f} {unit}"
-        size_in_bytes /= 1024.0
-    return f"{size_in_bytes:.2f} TB"
+    # Unit index straight from the bit length: every 10 bits is one 1024x step
+    if size_in_bytes <= 0:
+        return "0.00 B"
+    i = min(int(size_in_bytes).bit_length() - 1, 40) // 10
+    return f"{size_in_bytes / (1 << (i * 10)):.2f} {_UNITS[i]}"
+
+# --- Conversion Cache ---
+# Converted Markdown is stored on disk keyed by a hash of the uploaded bytes,
+# so re-uploads and app restarts skip the MarkItDown pipeline entirely.
+_CACHE_DIR = Path(tempfile.gettempdir()) / "aitp-md-cache"
+_CACHE_TTL = 24 * 60 * 60  # seconds
+
+def _ensure_cache_dir():
+    """
+    Creates the cache directory private to this user. Results are served from it,
+    so a directory (or symlink) planted by another local user is refused.
+    """
+    _CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    info = os.lstat(_CACHE_DIR)
+    if not stat.S_ISDIR(info.st_mode) or (hasattr(os, "getuid") and info.st_uid != os.getuid()):
+        raise PermissionError(f"Refusing to use cache directory not owned by this user: {_CACHE_DIR}")
+    if info.st_mode & 0o077:
+        os.chmod(_CACHE_DIR, 0o700)
+
+def _write_atomic(path, text):
+    """Writes text via a temp file + rename so concurrent readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".part")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+@st.cache_resource(ttl=60 * 60, show_spinner=False)
+def sweep_cache_dir():
+    """
+    Deletes cache files older than the TTL. Runs at most once an hour per process,
+    since entries that are never requested again would otherwise stay forever.
+    """
+    cutoff = time.time() - _CACHE_TTL
+    try:
+        entries = list(_CACHE_DIR.iterdir())
+    except OSError:
+        return
+    for path in entries:
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+# The in-memory memo expires with the disk entry it vouches for
+@st.cache_data(max_entries=MAX_STORED_RESULTS, ttl=_CACHE_TTL, show_spinner=False)
+def convert_cached(key, suffix, _stream, _converter):
+    """
+    Converts a binary stream to Markdown and stores it in the on-disk cache as
+    {key}.md, unless a fresh entry is already there. `key` identifies the content
+    (hash of the bytes plus suffix), so the stream itself never needs to be hashed
+    or copied by Streamlit.
+    Returns: {'converted_size': utf8_byte_count}.
+    Raises on conversion or cache-write failure (failures are not cached).
+    """
+    _ensure_cache_dir()
+    content_path = _CACHE_DIR / f"{key}.md"
+    meta_path = _CACHE_DIR / f"{key}.json"
+
+    # The metadata file is written last, so its presence implies the content is complete
+    try:
+        if time.time() - meta_path.stat().st_mtime < _CACHE_TTL:
+            meta = json.loads(meta_path.read_text("utf-8"))
+            # Restart the TTL so the files outlive the memo entry created here
+            os.utime(content_path)
+            os.utime(meta_path)
+            return {'converted_size': meta['converted_size']}
+        # Expired: drop the stale pair now rather than waiting for the sweep
+        meta_path.unlink(missing_ok=True)
+        content_path.unlink(missing_ok=True)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    content = _converter.convert(_stream, suffix)
+    # Measure the UTF-8 size once here; cached results carry it from now on
+    converted_size = len(content.encode('utf-8'))
+
+    # Results are served from these files, so a failed write fails the conversion
+    _write_atomic(content_path, content)
+    _write_atomic(meta_path, json.dumps({'converted_size': converted_size}))
+
+    return {'converted_size': converted_size}
+
+# --- Helper: Stored Results ---
+# Converted text stays in the on-disk conversion cache; session_state only holds
+# its key. The cap is global across sessions, so with many active users older
+# results are read from disk again. cache_resource rather than cache_data: the
+# bytes are immutable, so hits share one object instead of unpickling a copy.
+@st.cache_resource(max_entries=MAX_STORED_RESULTS, show_spinner=False)
+def _payload(key):
+    """UTF-8 bytes of a stored result, shared by the preview and both download buttons."""
+    return (_CACHE_DIR / f"{key}.md").read_bytes()
 
 # --- The Engine Class ---
 class DocumentConverter:
-    def __init__(self):
-        self.md = MarkItDown()
+    def __init__(self, use_process_pool=False):
+        self.md = new_markitdown()
+        self.use_process_pool = use_process_pool
+
+    def convert(self, stream, suffix):
+        """
+        Converts a binary stream in memory. GIL-bound formats are handed to the
+        process pool when enabled; everything else converts inline.
+        Returns: markdown text. Raises on failure.
+        """
+        if self.use_process_pool and suffix.lower() in PROCESS_POOL_SUFFIXES:
+            pool = get_process_pool()
+            try:
+                # Sending the upload to another process means pickling a bytes object,
+                # so this is the one full copy the zero-copy path can't avoid
+                return pool.submit(convert_bytes, stream.getvalue(), suffix).result()
+            except concurrent.futures.BrokenExecutor:
+                # A worker died (e.g. OOM). Rebuild the pool for later files, but
+                # convert this one inline rather than risk killing the new pool too.
+                logger.warning("Conversion process pool broke; rebuilding it and converting %s inline", suffix)
+                with get_pool_lock():
+                    if get_process_pool() is pool:
+                        get_process_pool.clear()
+                        pool.shutdown(wait=False, cancel_futures=True)
+                stream.seek(0)
+
+        return convert_stream(self.md, stream, suffix)
 
     def process_file(self, uploaded_file):
         """
-        Saves uploaded file temporarily, converts it, and cleans up.
-        Returns: (success_boolean, content_or_error_message)
+        Converts an uploaded file, reusing cached results where possible.
+        Returns: (success_boolean, {'key', 'converted_size'} or error message)
         """
         suffix = os.path.splitext(uploaded_file.name)[1]
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_path = tmp_file.name
 
-        try:
-            result = self.md.convert(tmp_path)
-            if not result or not result.text_content:
-                raise ValueError("Conversion yielded empty result.")
-            return True, result.text_content
+        # Hash the upload's buffer in place; getvalue() would copy the whole file
+        with uploaded_file.getbuffer() as view:
+            key = xxhash.xxh128(view).hexdigest() + suffix
+        # PDF output depends on the engine, so switching engines must not hit old entries
+        if suffix.lower() == ".pdf":
+            key = f"{key}-{PDF_ENGINE}"
+        uploaded_file.seek(0)
 
+        try:
+            return True, {**convert_cached(key, suffix, uploaded_file, self), 'key': key}
         except Exception as e:
             return False, str(e)
-            
-        finally:
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
+
+# --- Shared Resources ---
+@st.cache_resource
+def get_pool_lock():
+    """Guards rebuilding the process pool; cached because the script re-executes on every rerun."""
+    return threading.Lock()
+
+@st.cache_resource
+def get_process_pool():
+    """Worker processes for GIL-bound formats. Spawned rather than forked, since the server is multithreaded."""
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=PROCESS_POOL_WORKERS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+@st.cache_resource
+def get_converter():
+    """MarkItDown setup (magika model load etc.) is expensive, so build it once per process."""
+    return DocumentConverter(use_process_pool=True)
+
+# --- Result Rendering ---
+# Each result renders in its own fragment, so interacting with one file's widgets
+# reruns just that fragment instead of the whole N-file loop.
+@st.fragment
+def render_result(item):
+    with st.expander(f"✅ Result: {item['name']}", expanded=True):
+        # Expander bodies run even when collapsed, so the preview is opt-in
+        show_preview = st.toggle("Show preview", key=f"show_{item['name']}")
+        try:
+            data = _payload(item['key'])
+        except OSError:
+            st.warning("This result has expired. Remove and re-upload the file to convert it again.")
+            return
+
+        if show_preview:
+            st.text_area("Preview", value=data.decode("utf-8"), height=200, key=f"preview_{item['name']}")
+
+        base_name = os.path.splitext(item['name'])[0]
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("⬇️ Markdown (.md)", data, f"{base_name}.md", key=f"md_{item['name']}")
+        with col2:
+            st.download_button("⬇️ Text (.txt)", data, f"{base_name}.txt", key=f"txt_{item['name']}")
+
+# Not a fragment: the row has no widgets, so nothing could trigger a scoped rerun
+def render_comparison(item):
+    orig_fmt = format_size(item['original_size'])
+    new_fmt = format_size(item['converted_size'])
+
+    # Calculate percentage reduction
+    if item['original_size'] > 0:
+        reduction = ((item['original_size'] - item['converted_size']) / item['original_size']) * 100
+        reduction_str = f"{reduction:.1f}% smaller"
+        color_class = "highlight-green" if reduction > 0 else "highlight-red"
+    else:
+        reduction_str = "N/A"
+        color_class = ""
+
+    # Display Logic
+    st.markdown(f"**📄 File:** `{item['name']}`")
+
+    # Create a 3-column layout for the table row
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Original Size", orig_fmt)
+    c2.metric("Text Size", new_fmt)
+    c3.markdown(f"<div style='padding-top: 15px;' class='{color_class}'>{reduction_str}</div>", unsafe_allow_html=True)
+
+    st.divider()
 
 # --- Main Application Logic ---
 def main():
+    # Page setup lives here rather than at module level: spawned worker processes
+    # re-import this file as __mp_main__ and must not issue Streamlit commands
+    st.set_page_config(
+        page_title="Universal Document to Markdown Converter",
+        page_icon="📝",
+        layout="centered"
+    )
+    st.markdown(_CSS, unsafe_allow_html=True)
+
     st.title("📝 Doc-to-MD Converter")
+    sweep_cache_dir()
 
     # Initialize session state to store stats across tabs
     if 'conversion_stats' not in st.session_state:
-        st.session_state.conversion_stats = []
+        st.session_state.conversion_stats = OrderedDict()
+    # Names are tracked separately so results evicted from the LRU aren't reconverted on every rerun
+    if 'processed_names' not in st.session_state:
+        st.session_state.processed_names = set()
 
     # Create Tabs
     tab1, tab2 = st.tabs(["🚀 Converter", "📊 File Size Comparison"])
@@ -88,49 +304,79 @@ def main():
             accept_multiple_files=True
         )
 
+        # Forget files that left the uploader, so removing and re-adding one converts it again
+        st.session_state.processed_names &= {f.name for f in uploaded_files or []}
+
         if uploaded_files:
-            converter = DocumentConverter()
+            converter = get_converter()
             
             # Reset stats on new upload if you want fresh stats every time (optional)
-            # st.session_state.conversion_stats = [] 
-
-            for uploaded_file in uploaded_files:
-                # Check if we already processed this specific file to avoid re-processing on refresh
-                # (Simple check by name, usually sufficient for this demo)
-                already_processed = any(s['name'] == uploaded_file.name for s in st.session_state.conversion_stats)
-                
-                if not already_processed:
-                    with st.spinner(f"Reading {uploaded_file.name}..."):
-                        success, content = converter.process_file(uploaded_file)
-                        
+            # st.session_state.conversion_stats.clear()
+            # st.session_state.processed_names.clear()
+
+            # Check if we already processed this specific file to avoid re-processing on refresh
+            # (Simple check by name, usually sufficient for this demo)
+            pending = [
+                f for f in uploaded_files
+                if f.name not in st.session_state.processed_names
+            ]
+
+            if pending:
+                workers = min(MAX_BATCH_WORKERS, len(pending))
+                with st.status(f"Reading {len(pending)} file(s)...", expanded=True) as status, \
+                        concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = {executor.submit(converter.process_file, f): f for f in pending}
+                    failed = False
+
+                    # Report progress as files finish, in whatever order that is
+                    for future in concurrent.futures.as_completed(futures):
+                        uploaded_file = futures[future]
+                        success, result = future.result()
+
                         if success:
-                            # Calculate Stats
-                            original_size = uploaded_file.size
-                            converted_size = len(content.encode('utf-8'))
-                            
-                            # Add to session state
-                            st.session_state.conversion_stats.append({
-                                'name': uploaded_file.name,
-                                'original_size': original_size,
-                                'converted_size': converted_size,
-                                'content': content
-                            })
+                            st.write(f"Converted {uploaded_file.name}")
                         else:
-                            st.error(f"⚠️ Could not read [{uploaded_file.name}]. Error: {content}")
+                            failed = True
+                            st.error(f"⚠️ Could not read [{uploaded_file.name}]. Error: {result}")
+
+                    # Store results in upload order (futures keeps pending's order), so the
+                    # display order and which results the LRU evicts don't depend on timing
+                    stats = st.session_state.conversion_stats
+                    evicted_names = []
+                    for future, uploaded_file in futures.items():
+                        success, result = future.result()
+                        if not success:
+                            continue
+
+                        # Add to session state, evicting the oldest results past the cap
+                        stats[uploaded_file.name] = {
+                            'name': uploaded_file.name,
+                            'original_size': uploaded_file.size,
+                            'converted_size': result['converted_size'],
+                            'key': result['key']
+                        }
+                        stats.move_to_end(uploaded_file.name)
+                        while len(stats) > MAX_STORED_RESULTS:
+                            _, evicted = stats.popitem(last=False)
+                            evicted_names.append(evicted['name'])
+                        st.session_state.processed_names.add(uploaded_file.name)
+
+                    if failed:
+                        status.update(label="Some files could not be converted", state="error")
+                    else:
+                        status.update(label="Conversion complete", state="complete", expanded=False)
+
+                if evicted_names:
+                    st.info(
+                        f"Only the {MAX_STORED_RESULTS} most recent results are kept. "
+                        f"Removed: {', '.join(evicted_names)}. Remove and re-upload a file to convert it again."
+                    )
 
             # Display Results for all successful items in session state
             if st.session_state.conversion_stats:
                 st.write("---")
-                for item in st.session_state.conversion_stats:
-                    with st.expander(f"✅ Result: {item['name']}", expanded=True):
-                        st.text_area("Preview", value=item['content'], height=200, key=f"preview_{item['name']}")
-                        
-                        base_name = os.path.splitext(item['name'])[0]
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            st.download_button("⬇️ Markdown (.md)", item['content'], f"{base_name}.md", key=f"md_{item['name']}")
-                        with col2:
-                            st.download_button("⬇️ Text (.txt)", item['content'], f"{base_name}.txt", key=f"txt_{item['name']}")
+                for item in st.session_state.conversion_stats.values():
+                    render_result(item)
 
     # --- TAB 2: File Size Comparison ---
     with tab2:
@@ -139,29 +385,8 @@ def main():
         else:
             st.subheader("Compression Analysis")
             
-            for item in st.session_state.conversion_stats:
-                orig_fmt = format_size(item['original_size'])
-                new_fmt = format_size(item['converted_size'])
-                
-                # Calculate percentage reduction
-                if item['original_size'] > 0:
-                    reduction = ((item['original_size'] - item['converted_size']) / item['original_size']) * 100
-                    reduction_str = f"{reduction:.1f}% smaller"
-                    color_class = "highlight-green" if reduction > 0 else "highlight-red"
-                else:
-                    reduction_str = "N/A"
-                    color_class = ""
-
-                # Display Logic
-                st.markdown(f"**📄 File:** `{item['name']}`")
-                
-                # Create a 3-column layout for the table row
-                c1, c2, c3 = st.columns(3)
-                c1.metric("Original Size", orig_fmt)
-                c2.metric("Text Size", new_fmt)
-                c3.markdown(f"<div style='padding-top: 15px;' class='{color_class}'>{reduction_str}</div>", unsafe_allow_html=True)
-                
-                st.divider()
+            for item in st.session_state.conversion_stats.values():
+                render_comparison(item)
 
 if __name__ == "__main__":
     main()
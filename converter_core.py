@@ -0,0 +1,104 @@
+"""
+Conversion engine shared by the Streamlit app and its worker processes.
+Workers run functions from this module by name; the app module can't host them
+because Streamlit executes it as __main__. Spawned workers still re-import
+app.py as __mp_main__, so that file keeps its Streamlit commands inside main().
+"""
+import inspect
+import io
+import os
+from markitdown import MarkItDown, StreamInfo
+
+try:
+    import pymupdf
+    import pymupdf4llm
+except ImportError:
+    pymupdf4llm = None
+
+# Newer pymupdf4llm releases default to an ONNX layout analyzer that is several
+# times slower than MarkItDown on plain text PDFs; use the classic extractor
+if pymupdf4llm and hasattr(pymupdf4llm, "use_layout"):
+    pymupdf4llm.use_layout(False)
+
+# PDF engine: "auto" (pymupdf4llm, falling back to MarkItDown), "pymupdf", or "markitdown"
+PDF_ENGINE = os.environ.get("AITP_PDF_ENGINE", "auto").lower()
+
+# The uploader only accepts these extensions, so the type is known up front
+_EXT_TO_MIME = {
+    '.pdf': 'application/pdf',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    '.html': 'text/html',
+    '.htm': 'text/html',
+}
+
+def new_markitdown():
+    """
+    Builds a MarkItDown that trusts an explicit MIME type instead of sniffing
+    the content with magika. Streams without a MIME hint are still sniffed.
+    Note that trusted streams also skip charset detection, so HTML without an
+    explicit charset is decoded with MarkItDown's UTF-8 default.
+    """
+    md = MarkItDown()
+    guess = getattr(md, "_get_stream_info_guesses", None)
+    # Private API: only patch the signature this was written against, so a future
+    # release that changes it falls back to normal sniffing instead of a TypeError
+    if guess is None or list(inspect.signature(guess).parameters) != ['file_stream', 'base_guess']:
+        return md
+
+    def trusted_guesses(file_stream, base_guess):
+        if base_guess.mimetype:
+            return [base_guess]
+        return guess(file_stream=file_stream, base_guess=base_guess)
+
+    md._get_stream_info_guesses = trusted_guesses
+    return md
+
+def convert_stream(md, stream, suffix):
+    """
+    Converts a binary stream in memory with the best available engine.
+    Returns: markdown text. Raises on failure.
+    """
+    if suffix.lower() == ".pdf" and pymupdf4llm and PDF_ENGINE != "markitdown":
+        try:
+            return _convert_pdf(stream)
+        except Exception:
+            if PDF_ENGINE == "pymupdf":
+                raise
+        stream.seek(0)
+
+    stream_info = StreamInfo(extension=suffix, mimetype=_EXT_TO_MIME.get(suffix.lower()))
+    result = md.convert_stream(stream, stream_info=stream_info)
+    if not result or not result.text_content:
+        raise ValueError("Conversion yielded empty result.")
+    return result.text_content
+
+def _convert_pdf(stream):
+    """
+    Converts a PDF with pymupdf4llm, which is much faster than MarkItDown's
+    pdfminer path and keeps headings and tables.
+    """
+    with pymupdf.open(stream=stream, filetype="pdf") as doc:
+        text = pymupdf4llm.to_markdown(doc, page_chunks=False)
+    if not text or not text.strip():
+        raise ValueError("Conversion yielded empty result.")
+    return text
+
+# --- Process-Pool Worker ---
+_worker_md = None
+
+def convert_bytes(data, suffix):
+    """
+    Process-pool entry point: converts raw bytes with a per-process MarkItDown.
+    Returns: markdown text. Raises ValueError with the original message on failure.
+    """
+    global _worker_md
+    if _worker_md is None:
+        _worker_md = new_markitdown()
+    try:
+        return convert_stream(_worker_md, io.BytesIO(data), suffix)
+    except Exception as e:
+        # The exception is pickled back to the parent, and MarkItDown's
+        # FileConversionException holds tracebacks that can't be pickled
+        raise ValueError(str(e)) from None